@@ -1,28 +1,65 @@
-from typing import Literal, Optional
+from typing import Annotated, Literal, Optional
 from datetime import date
-import json
-
+import asyncio
+import functools
+import hashlib
+import operator
+import sys
+import uuid
+
+import httpx
+import orjson
+from pydantic import BaseModel, Field, model_validator
+
+from langchain_core.messages import HumanMessage
+from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
-from langgraph.graph import StateGraph, Command, START, END
-from langgraph.prebuilt import MessagesState, create_react_agent
-from langgraph.prebuilt.react import tool
+from langgraph.graph import StateGraph, START, END
+from langgraph.prebuilt import create_react_agent
+from langgraph.types import CachePolicy, Command
+from langgraph.cache.memory import InMemoryCache
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 ###############################################################################
 # 1. 状態定義
 ###############################################################################
 
-class QueryState(MessagesState):
+class QueryState(BaseModel):
     """
     LangGraphで各ノード間をやり取りする際に共有する状態。
-    - query: 質問や途中生成される回答を格納
+    pydantic モデルなので、各ノードには QueryState のインスタンスが渡され state.xxx で参照できる。
+    (サブグラフとのやり取りは HumanMessage を直接渡しており、messages チャネルは持たない)
+    - query_parts: 質問や途中生成される回答を追記順に格納 (operator.add で追記マージ)
+    - query: query_parts を改行で連結した文字列 (LLMに渡す直前にだけ組み立てる)
+      読み取り専用のため、初期状態は QueryState(query_parts=["質問"]) のように渡す
+      (QueryState(query="...") はエラーになる)
     - agent2_judgment: Agent2のYes/No
     - agent4_judgment: Agent4のYes/No
-    - debug_info: 全体の処理履歴などを文字列で蓄積
+    - debug_info: 全体の処理履歴などを文字列で蓄積 (並列ノードの追記も operator.add でマージ)
+    - retry_count: Prompt2 でブラッシュアップした回数
+    - last_answer_hash: 直前の回答(Prompt1の回答案 / Prompt2の回答)のハッシュ (収束判定用)
     """
-    query: str = ""
+    # list のデフォルトを [] にするとインスタンス間で共有されるため default_factory を使う
+    query_parts: Annotated[list[str], operator.add] = Field(default_factory=list)
     agent2_judgment: Optional[Literal["Yes", "No"]] = None
     agent4_judgment: Optional[Literal["Yes", "No"]] = None
-    debug_info: list = []
+    debug_info: Annotated[list, operator.add] = Field(default_factory=list)
+    retry_count: int = 0
+    last_answer_hash: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def _reject_query(cls, data):
+        # 以前の QueryState(query="...") は未知のフィールドとして無視され、質問が空になってしまうため明示的に弾く
+        if isinstance(data, dict) and "query" in data:
+            raise ValueError('QueryState no longer accepts "query"; pass query_parts=[...] instead')
+        return data
+
+    @property
+    def query(self) -> str:
+        # 各ノードで文字列を連結し直すと履歴が伸びるほど O(n^2) でコピーが増えるため、
+        # 追記はリストに対して行い、文字列化は参照時に1回だけ行う
+        return "\n".join(self.query_parts)
 
 
 ###############################################################################
@@ -30,8 +67,12 @@ class QueryState(MessagesState):
 #
 #   - "@tool" デコレータを使うと、ReActエージェントが呼び出せるツールとして自動登録されます
 #   - docstring(Triple-quoted) がそのままLLMに渡るため、なるべく「入力/出力形式」を明記するのが望ましい
+#   - 入力文字列だけで結果が決まるツールは functools.lru_cache でメモ化し、
+#     ReActループ内で同じ引数の呼び出しが繰り返されても再計算しない
 ###############################################################################
 
+TOOL_CACHE_SIZE = 1024
+
 ##
 # Agent1向けツール
 ##
@@ -64,6 +105,7 @@ def agent2_tool1_check_dictionary(input_text: str) -> str:
 # Agent3向けツール
 ##
 @tool
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def agent3_tool1_search_document(query: str) -> str:
     """
     This tool searches documents for 'query' and returns a dummy string result.
@@ -72,6 +114,7 @@ def agent3_tool1_search_document(query: str) -> str:
     return f"[Document] Found info about '{query}'"
 
 @tool
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def agent3_tool2_search_slack(query: str) -> str:
     """
     This tool searches Slack for 'query' and returns a dummy string result.
@@ -80,6 +123,7 @@ def agent3_tool2_search_slack(query: str) -> str:
     return f"[Slack] Found info about '{query}'"
 
 @tool
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def agent3_tool3_search_github_issue(query: str) -> str:
     """
     This tool searches GitHub issues for 'query' and returns a dummy string result.
@@ -88,6 +132,7 @@ def agent3_tool3_search_github_issue(query: str) -> str:
     return f"[GitHubIssue] Found info about '{query}'"
 
 @tool
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
 def agent3_tool4_search_internet(term: str) -> str:
     """
     This tool searches the Internet for 'term' and returns a dummy string result.
@@ -95,6 +140,21 @@ def agent3_tool4_search_internet(term: str) -> str:
     """
     return f"[Internet] Found info about '{term}'"
 
+@tool
+async def agent3_tool_search_all(query: str) -> str:
+    """
+    This tool searches documents, Slack, GitHub issues and the Internet for 'query' at once.
+    Output format: the retrieved info from each source, one per line.
+    """
+    # 4つの検索は互いに独立したI/Oなので、逐次ではなく並行に実行する
+    results = await asyncio.gather(
+        agent3_tool1_search_document.ainvoke(query),
+        agent3_tool2_search_slack.ainvoke(query),
+        agent3_tool3_search_github_issue.ainvoke(query),
+        agent3_tool4_search_internet.ainvoke(query),
+    )
+    return "\n".join(results)
+
 ##
 # Agent4向けツール
 ##
@@ -105,10 +165,13 @@ def agent4_tool1_check_unanswered(input_json: str) -> str:
     input_json = { "query": "...", "answer_candidate": "..." }
     Output: "Yes" if all answered, "No" if something is missing.
     """
-    data = json.loads(input_json)
-    query = data["query"]
-    answer_candidate = data["answer_candidate"]
+    data = orjson.loads(input_json)
+    # JSONの空白や並び順の違いでキャッシュが外れないよう、パース後の値をキーにする
+    return _check_unanswered(data["query"], data["answer_candidate"])
+
 
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
+def _check_unanswered(query: str, answer_candidate: str) -> str:
     # ダミー判定: "詳しく" が query にあるが answer_candidate に無い→ No
     if "詳しく" in query and "詳しく" not in answer_candidate:
         return "No"
@@ -121,9 +184,14 @@ def agent4_tool2_check_technical_words(input_json: str) -> str:
     input_json = { "query": "...", "answer_candidate": "..." }
     Output: "Yes" if the answer is easy enough, "No" if it's too difficult.
     """
-    data = json.loads(input_json)
+    data = orjson.loads(input_json)
+    return _check_technical_words(data["answer_candidate"])
+
+
+@functools.lru_cache(maxsize=TOOL_CACHE_SIZE)
+def _check_technical_words(answer_candidate: str) -> str:
     # ここでは雑に "専門用語" が回答に入っていればNoとする
-    if "専門用語" in data["answer_candidate"]:
+    if "専門用語" in answer_candidate:
         return "No"
     return "Yes"
 
@@ -131,15 +199,57 @@ def agent4_tool2_check_technical_words(input_json: str) -> str:
 ###############################################################################
 # 3. 各Agent(= ReActエージェント)の定義: create_react_agent
 ###############################################################################
+# LLMクライアントはモジュールで1回だけ生成し、呼び出し間で使い回す。
+# 接続プールは fork をまたいで引き継がないこと: fork 前の親プロセスではLLMを呼ばない
+# (preload_agents はサブグラフを組み立てるだけで接続は張らないので fork 前に呼んでよい)
 model = ChatOpenAI(temperature=0.0)
 
+# create_react_agent はツールのスキーマ解決やサブグラフ構築を行うため、import時に毎回作るのではなく
+# build_agent で初回利用時に1回だけ生成し、プロセス内で使い回す。
+# lru_cache のキーにできるよう、ツールは名前のタプルで指定する。
+TOOLS = {
+    t.name: t
+    for t in [
+        agent1_tool1_check_date_in_query,
+        agent2_tool1_check_dictionary,
+        agent3_tool_search_all,
+        agent4_tool1_check_unanswered,
+        agent4_tool2_check_technical_words,
+    ]
+}
+
+
+@functools.lru_cache(maxsize=None)
+def build_agent(name: str, tool_names: tuple[str, ...], description: str):
+    return create_react_agent(
+        llm = model,
+        tools = [TOOLS[tool_name] for tool_name in tool_names],
+        name = name,
+        description = description,
+        # サブグラフは呼び出しごとに新しいメッセージ列から始める。
+        # 親グラフのチェックポインタを引き継ぐと過去の会話履歴が毎回LLMに送られ、トークン数が膨らむため無効化
+        checkpointer = False
+    )
+
+
+def preload_agents():
+    """
+    グラフから実際に呼ばれるエージェント(Agent3/Agent4)を事前に生成しておく。
+    ワーカーを fork するサーバでは親プロセスで呼んでおくと、生成済みのサブグラフを子プロセスで共有できる。
+    Agent1/Agent2 は現状ツールを直接呼んでいるため、必要になった時点で build_agent により遅延生成する。
+    """
+    for spec in (AGENT3_SPEC, AGENT4_SPEC):
+        build_agent(**spec)
+
+
 # Agent1: agent1_tool1_check_date_in_query
 #   → "最新の" や "現在の" が入っているか調べ、あれば日付を返すツール
 #   → ここではあまり複雑でないため1つのツールだけ割り当て。
-agent1_graph = create_react_agent(
-    llm = model,
-    tools = [agent1_tool1_check_date_in_query],
+#   → 現状のツールは判定が決定的なため call_agent1 からは直接ツールを呼んでおり、
+#     このReActエージェントは判断にLLMが必要なツールを追加したとき用に残している。
+AGENT1_SPEC = dict(
     name = "agent1_react",
+    tool_names = ("agent1_tool1_check_date_in_query",),
     description = """
     Agent1: Given the user's query, clarify or regenerate the query to make it easier to answer.
     Tools:
@@ -151,10 +261,10 @@ agent1_graph = create_react_agent(
 
 # Agent2: agent2_tool1_check_dictionary
 #   → "特殊用語" があるかどうかをチェック。Yes/Noを最終回答として返す
-agent2_graph = create_react_agent(
-    llm = model,
-    tools = [agent2_tool1_check_dictionary],
+#   → Agent1と同様、現状は call_agent2 から直接ツールを呼ぶ (このエージェントは将来用)
+AGENT2_SPEC = dict(
     name = "agent2_react",
+    tool_names = ("agent2_tool1_check_dictionary",),
     description = """
     Agent2: Judge whether the query contains unknown technical words, returning "Yes" or "No".
     Tools:
@@ -163,19 +273,15 @@ agent2_graph = create_react_agent(
     """
 )
 
-# Agent3: 4つのツールを用いて不足情報を収集する
-agent3_graph = create_react_agent(
-    llm = model,
-    tools = [
-        agent3_tool1_search_document,
-        agent3_tool2_search_slack,
-        agent3_tool3_search_github_issue,
-        agent3_tool4_search_internet
-    ],
+# Agent3: 4つの情報源をまとめて並行検索するツールで不足情報を収集する
+#   → 個別の4ツールをLLMに順番に呼ばせると4往復かかるため、agent3_tool_search_all の1回に集約
+AGENT3_SPEC = dict(
     name = "agent3_react",
+    tool_names = ("agent3_tool_search_all",),
     description = """
     Agent3: Collect missing info from multiple sources (document, slack, github issue, internet).
-    You can call any or all tools as needed.
+    Tools:
+      - agent3_tool_search_all (searches all sources concurrently)
     The final answer from this agent should be a summary of what you've found.
     """
 )
@@ -183,10 +289,9 @@ agent3_graph = create_react_agent(
 # Agent4: 作られた回答が分かりやすいかチェック ("Yes"/"No")
 #   → agent4_tool1_check_unanswered
 #   → agent4_tool2_check_technical_words
-agent4_graph = create_react_agent(
-    llm = model,
-    tools = [agent4_tool1_check_unanswered, agent4_tool2_check_technical_words],
+AGENT4_SPEC = dict(
     name = "agent4_react",
+    tool_names = ("agent4_tool1_check_unanswered", "agent4_tool2_check_technical_words"),
     description = """
     Agent4: Evaluate the final answer to see if it fully addresses the query and is not too technical.
     Use these two tools and combine their results.
@@ -205,73 +310,83 @@ agent4_graph = create_react_agent(
 #   LangGraph でサブグラフ(= ReAct agent)を扱う場合は、直接 add_node(agent1_graph)
 #   するのではなく、下記のように "ラッパ関数" を作って Command を返すと
 #   グラフの可視化や制御フローがより扱いやすくなります。
+#
+#   プロンプトキャッシュ(OpenAIの自動prefix cache等)を効かせるため、指示文は
+#   固定の文言を先頭に置き、毎回変わる state.query などは必ず末尾に付ける。
+#   固定部分にはタイムスタンプやUUIDなどを埋め込まないこと。
+#   サブグラフには毎回 HumanMessage 1件だけを渡す (debug_info などローカルの履歴は送らない)。
 ###############################################################################
 
-def call_agent1(state: QueryState) -> Command[Literal["agent2"]]:
+AGENT3_INSTRUCTIONS = (
+    "We need more info for the user query. Please gather from documents, Slack, GitHub issues, internet. "
+    "Finally, output a summary of what you found.\nUser Query: "
+)
+AGENT4_INSTRUCTIONS = (
+    "Check the answer thoroughly using your tools to see if it's fully answered and not too technical.\n"
+    "Finally, output 'Yes' if it's fully acceptable, else 'No'.\n"
+    "JSON to pass to each tool: "
+)
+
+def call_agent1(state: QueryState) -> Command[Literal["router1"]]:
     """
-    Agent1サブグラフを実行 → 生成物を state.query に反映し、agent2へ進む
+    Agent1のツールを直接実行 → 生成物を state.query に反映し、router1へ進む
+    (Agent2 とは START から並列に実行される)
     """
-    # ReActエージェントに渡すプロンプトとして、MessagesState["messages"] を使う方法もありますが
-    # ここでは簡単に指示文の末尾に state.query を与えるだけにします。
-    instructions = f"User Query: {state.query}\nPlease finalize your answer now."
-    result = agent1_graph.invoke({"messages": [{"role": "user", "content": instructions}]})
-    # result は ToolMessage, AIMessage, etc. の配列が返ってくる
-    # 最終回答(AIMessage)を抽出
-    final_ans = result[-1]["content"]
+    # 日付チェックは単純な部分文字列判定なので、ReActサブグラフ(LLM 1～2往復)を経由せず
+    # ツールを直接呼び出して結果を決める
+    date_str = agent1_tool1_check_date_in_query.invoke(state.query)
+    if date_str:
+        final_ans = f"appended date {date_str}"
+    else:
+        final_ans = "No date appended."
 
     # 例: Agent1の回答は「日付をappendしたかどうか」なので、それを state.query に取り込み
     # 実際の使い方は用途に合わせて変更
-    state.query = f"{state.query}\n[Agent1 says]: {final_ans}"
-    state.debug_info.append(f"[Agent1] {final_ans}")
-
     return Command(
-        goto="agent2",
-        update={"query": state.query, "debug_info": state.debug_info}
+        goto="router1",
+        update={
+            "query_parts": [f"[Agent1 says]: {final_ans}"],
+            "debug_info": [f"[Agent1] {final_ans}"]
+        }
     )
 
 
 def call_agent2(state: QueryState) -> Command[Literal["router1"]]:
     """
-    Agent2サブグラフを実行 → 最終回答("Yes"/"No")を parse して state.agent2_judgment に格納
+    Agent2のツールを直接実行 → 結果("Yes"/"No")を state.agent2_judgment に格納
     """
-    instructions = f"User Query: {state.query}\nReturn final answer as 'Yes' or 'No'."
-    result = agent2_graph.invoke({"messages": [{"role": "user", "content": instructions}]})
-    final_ans = result[-1]["content"].strip()
+    # Agent1と同様、"特殊用語" の有無は決定的に判定できるのでLLMを介さない
+    final_ans = agent2_tool1_check_dictionary.invoke(state.query)
 
     # Agent2の結果を state.agent2_judgment にセット
-    if final_ans not in ["Yes", "No"]:
-        # 万一 "Yes"/"No" 以外が来た場合のfallback
-        final_ans = "No"
     state.agent2_judgment = final_ans
-    state.debug_info.append(f"[Agent2] judged = {final_ans}")
 
     return Command(
         goto="router1",
         update={
             "agent2_judgment": state.agent2_judgment,
-            "debug_info": state.debug_info
+            "debug_info": [f"[Agent2] judged = {final_ans}"]
         }
     )
 
 
-def call_agent3(state: QueryState) -> Command[Literal["prompt1"]]:
+async def call_agent3(state: QueryState) -> Command[Literal["prompt1"]]:
     """
-    Agent3サブグラフを実行 → 取得した追加情報を state.query に付加して prompt1へ進む
+    Agent3サブグラフを(非同期で)実行 → 取得した追加情報を state.query に付加して prompt1へ進む
     """
-    instructions = (
-        "We need more info for the user query. Please gather from documents, Slack, GitHub issues, internet. "
-        f"User Query: {state.query}\nFinally, output a summary of what you found."
-    )
-    result = agent3_graph.invoke({"messages": [{"role": "user", "content": instructions}]})
-    final_ans = result[-1]["content"]
+    instructions = AGENT3_INSTRUCTIONS + state.query
+    result = await build_agent(**AGENT3_SPEC).ainvoke({"messages": [HumanMessage(content=instructions)]})
+    # result は {"messages": [HumanMessage, AIMessage, ToolMessage, ...]} の形で返ってくるので
+    # 最後のメッセージ(最終回答の AIMessage)の content を取り出す
+    final_ans = result["messages"][-1].content
 
     # 取得した情報を query に付加する例
-    state.query = f"{state.query}\n[Agent3 additional info]:\n{final_ans}"
-    state.debug_info.append(f"[Agent3] {final_ans}")
-
     return Command(
         goto="prompt1",
-        update={"query": state.query, "debug_info": state.debug_info}
+        update={
+            "query_parts": [f"[Agent3 additional info]:\n{final_ans}"],
+            "debug_info": [f"[Agent3] {final_ans}"]
+        }
     )
 
 
@@ -281,80 +396,231 @@ def call_agent4(state: QueryState) -> Command[Literal["router2"]]:
     """
     # Agent4は2つのツールを呼び出し、それぞれの結果をまとめて最終回答("Yes"/"No")を返す想定
     # ここでは query(=ユーザの質問) と answer_candidate(= 現在の回答) をJSONで渡すように促す
-    data_json = json.dumps({"query": state.query, "answer_candidate": state.query})
-    instructions = (
-        "Check the answer thoroughly using your tools to see if it's fully answered and not too technical.\n"
-        f"JSON to pass to each tool: {data_json}\n"
-        "Finally, output 'Yes' if it's fully acceptable, else 'No'."
-    )
-    result = agent4_graph.invoke({"messages": [{"role": "user", "content": instructions}]})
-    final_ans = result[-1]["content"].strip()
+    # prompt2 からのリトライでも指示文の先頭は同一になるよう、JSONは末尾に置く
+    # state.query は参照のたびに連結されるため、ノードに入った時点で1回だけ組み立ててJSON化する
+    query = state.query
+    data_json = orjson.dumps({"query": query, "answer_candidate": query}).decode()
+    instructions = AGENT4_INSTRUCTIONS + data_json
+    result = build_agent(**AGENT4_SPEC).invoke({"messages": [HumanMessage(content=instructions)]})
+    final_ans = result["messages"][-1].content.strip()
 
     if final_ans not in ["Yes", "No"]:
         final_ans = "No"
 
     state.agent4_judgment = final_ans
-    state.debug_info.append(f"[Agent4] judged = {final_ans}")
 
     return Command(
         goto="router2",
         update={
             "agent4_judgment": state.agent4_judgment,
-            "debug_info": state.debug_info
+            "debug_info": [f"[Agent4] judged = {final_ans}"]
         }
     )
 
 
 ###############################################################################
 # 5. Promptノード実装 (普通のLLM呼び出し; 必要ならReAct化してもOK)
+#
+#   Agentと同様、固定の指示文を先頭に、state.query を末尾に置く
+#   複数ユーザのリクエストが同時に来た場合に備え、LLM呼び出しは BatchingDispatcher 経由で
+#   短い時間窓にまとめて llm.abatch() で送る
 ###############################################################################
 
-def prompt1(state: QueryState) -> Command[Literal["agent4"]]:
-    """
-    Prompt1: 得られた情報をもとに一旦回答を生成し、次にAgent4へ渡す。
-    """
-    llm = ChatOpenAI()
-    prompt_text = f"""
+class BatchingDispatcher:
+    """
+    同時に投入されたプロンプトを max_wait 秒の時間窓(最大 max_batch_size 件)でまとめ、
+    llm.abatch() で一括送信して、結果(または失敗したプロンプトの例外)をそれぞれの呼び出し元の Future に返す。
+    ワーカータスクはイベントループごとに初回の submit 時に起動する。
+    httpx.AsyncClient の接続プールは生成したイベントループに紐づくため、HTTPクライアントと
+    LLM(llm_factory(http_async_client) で生成)もワーカーごとに作り、ワーカー終了時に閉じる。
+    """
+
+    def __init__(self, llm_factory, max_batch_size: int = 16, max_wait: float = 0.02):
+        self.llm_factory = llm_factory
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, prompt: str):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        sending = set()
+        try:
+            async with httpx.AsyncClient() as http_async_client:
+                llm = self.llm_factory(http_async_client)
+                try:
+                    while True:
+                        batch = [await self._queue.get()]
+                        deadline = loop.time() + self.max_wait
+                        while len(batch) < self.max_batch_size:
+                            timeout = deadline - loop.time()
+                            if timeout <= 0:
+                                break
+                            try:
+                                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                            except asyncio.TimeoutError:
+                                break
+
+                        # 送信完了を待たずに次のバッチの収集に戻る
+                        # (待つと、送信中に来たプロンプトが前のバッチの往復分だけ余計に待たされる)
+                        task = asyncio.create_task(self._send(llm, batch))
+                        sending.add(task)
+                        task.add_done_callback(sending.discard)
+                        batch = []
+                finally:
+                    # HTTPクライアントを閉じる前に、送信中のバッチを片付ける
+                    for task in list(sending):
+                        task.cancel()
+                    await asyncio.gather(*sending, return_exceptions=True)
+        except BaseException as e:
+            # llm_factory やワーカー自体が失敗した場合、待っている呼び出し元が永久に待たないよう全て失敗させる
+            pending = batch
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            for _, future in pending:
+                if future.done():
+                    continue
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                else:
+                    future.cancel()
+            # 例外は呼び出し元に渡したので、キャンセル(ループ終了)のときだけ再送出する
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            # 次の submit で新しいワーカーを起動させる
+            if self._worker is asyncio.current_task():
+                self._worker = None
+
+    async def _send(self, llm, batch):
+        # 1件の失敗で同じバッチの他ユーザのリクエストまで失敗させないよう、
+        # 例外は各プロンプトの結果として受け取り、それぞれの Future にだけ返す
+        try:
+            responses = await llm.abatch(
+                [prompt for prompt, _ in batch], return_exceptions=True
+            )
+        except Exception as e:
+            # バッチ送信自体が失敗した場合のみ全件に例外を返す
+            responses = [e] * len(batch)
+        except BaseException:
+            for _, future in batch:
+                future.cancel()
+            raise
+        for (_, future), response in zip(batch, responses):
+            if future.done():
+                continue
+            if isinstance(response, Exception):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+
+# Prompt1/Prompt2 用のLLM。ノード呼び出しのたびに ChatOpenAI() を作らず、
+# BatchingDispatcher のワーカー(イベントループ)ごとに1つ生成して共有する
+def make_prompt_llm(http_async_client: httpx.AsyncClient) -> ChatOpenAI:
+    return ChatOpenAI(
+        temperature=0.0,
+        max_retries=2,
+        http_async_client=http_async_client
+    )
+
+
+prompt_dispatcher = BatchingDispatcher(make_prompt_llm)
+
+
+PROMPT1_INSTRUCTIONS = """
 あなたはユーザに回答するアシスタントです。
-[User Query & Collected Info]: {state.query}
+以下の質問に対して、一度回答案をまとめてください。
 
-この質問に対して、一度回答案をまとめてください。
+[User Query & Collected Info]:
 """
-    response = llm.invoke(prompt_text)
-    answer = response.content.strip()
 
-    state.query = f"{state.query}\n[Prompt1's answer draft]:\n{answer}"
-    state.debug_info.append(f"[Prompt1] generated answer draft:\n{answer}")
+PROMPT2_INSTRUCTIONS = """
+あなたは回答をブラッシュアップするアシスタントです。
+以下の前回の回答案は、まだ回答が不十分 or 専門的すぎると指摘されました。
+より分かりやすく、より詳細に説明する回答を再度作成してください。
+
+前回の回答案:
+"""
+
+# Prompt2 -> Agent2 のループ回数の上限 (1周ごとにLLM呼び出しが数回発生するため)
+MAX_RETRIES = 2
+
+
+def answer_hash(answer: str) -> str:
+    return hashlib.sha1(answer.encode()).hexdigest()
+
+
+def prompt2_next_node(retry_count: int, new_hash: str, last_hash: Optional[str]):
+    """
+    Prompt2 の遷移先と、その理由(debug_info 用、agent2 へ戻る場合は None)を返す。
+    収束判定を先に行うため、上限回数に達した回でも回答が変わっていなければ "unchanged" として終了する。
+    """
+    if new_hash == last_hash:
+        # 前回と同じ回答 = 収束したとみなし、Agent4 を再度呼ばずに終了
+        return END, "[Prompt2] answer unchanged => END"
+    if retry_count >= MAX_RETRIES:
+        return END, f"[Prompt2] reached MAX_RETRIES={MAX_RETRIES} => END"
+    # ブラッシュアップ後、Agent2へ戻る (再度専門用語チェックなど)
+    return "agent2", None
+
+
+
+async def prompt1(state: QueryState) -> Command[Literal["agent4"]]:
+    """
+    Prompt1: 得られた情報をもとに一旦回答を生成し、次にAgent4へ渡す。
+    """
+    prompt_text = PROMPT1_INSTRUCTIONS + state.query
+    response = await prompt_dispatcher.submit(prompt_text)
+    answer = response.content.strip()
 
     return Command(
         goto="agent4",
-        update={"query": state.query, "debug_info": state.debug_info}
+        update={
+            "query_parts": [f"[Prompt1's answer draft]:\n{answer}"],
+            # Prompt2 の1回目でも回答案から変化したかを判定できるよう、ハッシュを残しておく
+            "last_answer_hash": answer_hash(answer),
+            "debug_info": [f"[Prompt1] generated answer draft:\n{answer}"]
+        }
     )
 
 
-def prompt2(state: QueryState) -> Command[Literal["agent2"]]:
+async def prompt2(state: QueryState) -> Command[Literal["agent2", END]]:
     """
     Prompt2: Agent4がNoと判断した場合に再度回答をブラッシュアップする
+      - 回答が前回(Prompt1の回答案 or 前回のPrompt2)から変わらなかった場合、
+        または上限回数(MAX_RETRIES)に達した場合はこれ以上改善しないとみなし、その回答で END
+      - それ以外 -> agent2 へ戻る
     """
-    llm = ChatOpenAI()
-    prompt_text = f"""
-あなたは回答をブラッシュアップするアシスタントです。
-前回の回答案:
-{state.query}
-
-まだ回答が不十分 or 専門的すぎると指摘されました。
-より分かりやすく、より詳細に説明する回答を再度作成してください。
-"""
-    response = llm.invoke(prompt_text)
+    prompt_text = PROMPT2_INSTRUCTIONS + state.query
+    response = await prompt_dispatcher.submit(prompt_text)
     refined_answer = response.content.strip()
 
-    state.query = f"{state.query}\n[Prompt2 refined answer]:\n{refined_answer}"
-    state.debug_info.append(f"[Prompt2] refined answer:\n{refined_answer}")
+    retry_count = state.retry_count + 1
+    new_hash = answer_hash(refined_answer)
+    debug_info = [f"[Prompt2] refined answer:\n{refined_answer}"]
+
+    goto_node, reason = prompt2_next_node(retry_count, new_hash, state.last_answer_hash)
+    if reason:
+        debug_info.append(reason)
 
-    # ブラッシュアップ後、Agent2へ戻る (再度専門用語チェックなど)
     return Command(
-        goto="agent2",
-        update={"query": state.query, "debug_info": state.debug_info}
+        goto=goto_node,
+        update={
+            "query_parts": [f"[Prompt2 refined answer]:\n{refined_answer}"],
+            "retry_count": retry_count,
+            "last_answer_hash": new_hash,
+            "debug_info": debug_info
+        }
     )
 
 
@@ -374,8 +640,8 @@ def router1(state: QueryState) -> Command[Literal["prompt1", "agent3"]]:
     else:
         goto_node = "agent3"
 
-    state.debug_info.append(f"[Router1] Agent2 = {state.agent2_judgment} -> {goto_node}")
-    return Command(goto=goto_node, update={"debug_info": state.debug_info})
+    log = f"[Router1] Agent2 = {state.agent2_judgment} -> {goto_node}"
+    return Command(goto=goto_node, update={"debug_info": [log]})
 
 
 def router2(state: QueryState) -> Command[Literal["prompt2", END]]:
@@ -386,65 +652,119 @@ def router2(state: QueryState) -> Command[Literal["prompt2", END]]:
       - No  -> prompt2
     """
     if state.agent4_judgment == "Yes":
-        state.debug_info.append("[Router2] Agent4=Yes => END")
-        return Command(goto=END, update={"debug_info": state.debug_info})
+        return Command(goto=END, update={"debug_info": ["[Router2] Agent4=Yes => END"]})
     else:
-        state.debug_info.append("[Router2] Agent4=No => prompt2")
-        return Command(goto="prompt2", update={"debug_info": state.debug_info})
+        return Command(goto="prompt2", update={"debug_info": ["[Router2] Agent4=No => prompt2"]})
 
 
 ###############################################################################
 # 7. グラフ組み立て
 ###############################################################################
 
-def build_graph():
+# ノード単位のキャッシュ設定
+#   query のハッシュをキーにしてノードの出力(Command)を使い回す。
+#   1回の実行内では各ノードが query_parts に追記してから agent4 に進むため同じキーは出ず、
+#   ヒットするのは TTL 内に同じ質問で再実行した場合など、実行をまたいで同じ query が来たときのみ
+AGENT_CACHE_TTL = 300  # 秒
+
+
+def query_cache_key(state: QueryState) -> str:
+    return hashlib.sha1(state.query.encode()).hexdigest()
+
+
+AGENT_CACHE_POLICY = CachePolicy(key_func=query_cache_key, ttl=AGENT_CACHE_TTL)
+
+# キャッシュ本体はプロセス内で1つだけ持ち、build_graph を呼び直しても(実行ごとにグラフを作っても)共有する。
+# build_graph の中で毎回作ると実行のたびに空になり、ヒットしないまま保存コストだけがかかる
+node_cache = InMemoryCache()
+
+
+def build_graph(checkpointer=None, cache=node_cache):
+    """
+    グラフを組み立ててコンパイルする。
+    checkpointer (AsyncSqliteSaver 等) を渡すと各ステップの状態が永続化され、
+    クラッシュ後の再開や複数ワーカーでの実行ができる。
+    cache はノードキャッシュの保存先。既定ではモジュール共通の node_cache を使う
+    (サーバ等で長く生きる所有者がいれば、そちらのキャッシュを渡してもよい)。
+    """
     builder = StateGraph(QueryState)
 
     # 各ノード登録 (Agent1～Agent4は ReActサブグラフを呼び出す "ラッパ" 関数で登録)
-    builder.add_node(call_agent1,  name="agent1")
-    builder.add_node(call_agent2,  name="agent2")
-    builder.add_node(router1,      name="router1")
-    builder.add_node(call_agent3,  name="agent3")
-    builder.add_node(prompt1,      name="prompt1")
-    builder.add_node(call_agent4,  name="agent4")
-    builder.add_node(router2,      name="router2")
-    builder.add_node(prompt2,      name="prompt2")
+    # Agent4 は query だけで結果が決まるため、キャッシュを有効化
+    # (Agent1/2 はLLMを呼ばず十分軽いのでキャッシュしない)
+    builder.add_node("agent1", call_agent1)
+    builder.add_node("agent2", call_agent2)
+    # router1 は Agent1/Agent2 の並列ブランチの合流点。defer=True で両方の完了を待ってから実行する
+    builder.add_node("router1", router1, defer=True)
+    builder.add_node("agent3", call_agent3)
+    builder.add_node("prompt1", prompt1)
+    builder.add_node("agent4", call_agent4, cache_policy=AGENT_CACHE_POLICY)
+    builder.add_node("router2", router2)
+    builder.add_node("prompt2", prompt2)
 
     # エッジ定義
+    # Agent2 の辞書チェックは元の query だけで判定でき、Agent1 の日付付加に依存しないため並列に実行
     builder.add_edge(START, "agent1")     # query => Agent1
-    builder.add_edge("agent1", "agent2")  # Agent1 => Agent2
+    builder.add_edge(START, "agent2")     # query => Agent2
+    builder.add_edge("agent1", "router1") # Agent1 => Router1
     builder.add_edge("agent2", "router1") # Agent2 => Router1
-    builder.add_edge("router1", "prompt1")
-    builder.add_edge("router1", "agent3")
     builder.add_edge("agent3", "prompt1") # Agent3 => Prompt1
     builder.add_edge("prompt1", "agent4") # Prompt1 => Agent4
     builder.add_edge("agent4", "router2") # Agent4 => Router2
-    builder.add_edge("router2", END)
-    builder.add_edge("router2", "prompt2")
-    builder.add_edge("prompt2", "agent2")
+    # 分岐するノード(router1, router2, prompt2)の遷移先は Command(goto=...) だけで決め、
+    # 行き先は各関数の Command[Literal[...]] の型注釈で宣言する。
+    # 静的エッジは Command と無関係に毎回発火するため、張ると選ばなかった側の分岐も実行されてしまう
 
     # これで構造:
-    # query -> agent1 -> agent2 -> router1 -> [Yes->prompt1, No->agent3] -> prompt1 -> agent4 -> router2 -> [Yes->END, No->prompt2->agent2->...]
-    return builder.compile()
+    # query -> [agent1 || agent2] -> router1 -> [Yes->prompt1, No->agent3] -> prompt1 -> agent4 -> router2 -> [Yes->END, No->prompt2->[agent2->... or END (retry limit / converged)]]
+    return builder.compile(checkpointer=checkpointer, cache=cache)
 
 
 ###############################################################################
 # 8. 実行例
 ###############################################################################
 
-if __name__ == "__main__":
-    graph = build_graph()
+CHECKPOINT_DB = "graph.db"
 
-    # テスト用State
-    test_state = QueryState(
-        query="特殊用語について詳しく知りたいです。最新の情報も教えてください。"
-    )
 
-    final_state = graph.run(test_state)
+async def main(resume_thread_id: Optional[str] = None):
+    """
+    resume_thread_id を省略すると新しい thread_id で最初から実行する。
+    同じ thread_id で新しい入力を渡すと、reducer(operator.add)により前回の query_parts / debug_info に
+    追記され、retry_count なども引き継がれてしまうため、実行ごとに thread_id を発行する。
+    中断した実行を再開するときだけ、その thread_id を指定して入力なし(None)で ainvoke する。
+    """
+    preload_agents()
+
+    # 状態は SQLite に保存し、thread_id ごとに途中から再開できるようにする
+    async with AsyncSqliteSaver.from_conn_string(CHECKPOINT_DB) as checkpointer:
+        graph = build_graph(checkpointer=checkpointer)
+
+        if resume_thread_id is not None:
+            config = {"configurable": {"thread_id": resume_thread_id}}
+            return await graph.ainvoke(None, config=config)
+
+        # テスト用State
+        test_state = QueryState(
+            query_parts=["特殊用語について詳しく知りたいです。最新の情報も教えてください。"]
+        )
+        thread_id = str(uuid.uuid4())
+        print(f"thread_id: {thread_id}")
+        config = {"configurable": {"thread_id": thread_id}}
+        return await graph.ainvoke(test_state, config=config)
+
+
+if __name__ == "__main__":
+    # 引数に thread_id を渡すとその実行を再開する (例: python agent.py <thread_id>)
+    resume_thread_id = sys.argv[1] if len(sys.argv) > 1 else None
+
+    # Agent3 や Prompt ノードが非同期のため、グラフも非同期で実行する
+    final_state = asyncio.run(main(resume_thread_id))
 
     print("========== [Execution Finished] ==========")
     print("Final Query State:")
-    print(final_state.query)
+    # ainvoke はチャネル値の dict を返す (query は QueryState のプロパティなのでここには無い)
+    print("\n".join(final_state["query_parts"]))
     print("\n--- Debug Info ---")
-    for line in final_state.debug_info:
+    for line in final_state["debug_info"]:
         print(line)
@@ -1,25 +1,274 @@
+import functools
+import re
+
+import numba
+import numpy as np
+import pandas as pd
+
+# preprocess で使う正規表現は事前にコンパイルしておき、文字列1本あたりの走査回数を減らす
+_URL_RE = re.compile(r"https?://[\w!\?/\+\-_~=;\.,\*&@#\$%\(\)'\[\]]+")
+# 括弧書き、または許可文字以外の1文字を空白に置き換える
+_STRIP_RE = re.compile(r"\(.*?\)|[^a-zA-z0-9.,?!/&%$']")
+# 句点の連続(前後の空白含む)は ". " に、それ以外の空白の連続は " " にまとめる
+_SPACE_RE = re.compile(r"(?P<dots>\s*\.[\.\s]+)|\s+")
+# "' " -> "'", " l " -> " i ", " ," -> "," を1パスで行う (" l ," は " i," になる)
+_FIXUP_RE = re.compile(r"(?P<apos>' )|(?P<l_comma> l ,)|(?P<l> l )|(?P<comma> ,)")
+_FIXUP_REPL = {"apos": "'", "l_comma": " i,", "l": " i ", "comma": ","}
+# 1文字単位の置換は str.translate でまとめて行う
+_CHAR_TABLE = str.maketrans({"’": "'", ",": " , ", "!": ". ", ".": ". "})
+
+
+def _space_repl(match):
+    return ". " if match.group("dots") else " "
+
+
+def _fixup_repl(match):
+    return _FIXUP_REPL[match.lastgroup]
+
+
+def _preprocess_regex(text):
+    text = _URL_RE.sub(' ', text)
+    text = text.lower().translate(_CHAR_TABLE)
+    text = _STRIP_RE.sub(' ', text)
+    text = _SPACE_RE.sub(_space_repl, text)
+    text = _FIXUP_RE.sub(_fixup_repl, text)
+    text = text.strip()
+    if text[:2]=="l ":
+        text="i "+text[2:]
+    return text
+
+
+# ASCIIのみの文字列は、上の正規表現と同じ処理をバイト列上のループで行い Numba でネイティブコード化する
+@numba.njit(cache=True)
+def _is_url_char(c):
+    # [\w!\?/\+\-_~=;\.,\*&@#\$%\(\)'\[\]]
+    if (97 <= c <= 122) or (65 <= c <= 90) or (48 <= c <= 57):
+        return True
+    for x in b"_!?/+-~=;.,*&@#$%()'[]":
+        if c == x:
+            return True
+    return False
+
+
+@numba.njit(cache=True)
+def _is_allowed_char(c):
+    # [a-zA-z0-9.,?!/&%$'] (A-z は [\]^_` も含む)
+    if (65 <= c <= 122) or (48 <= c <= 57):
+        return True
+    for x in b".,?!/&%$'":
+        if c == x:
+            return True
+    return False
+
+
+@numba.njit(cache=True)
+def _preprocess_ascii(src):
+    SP, DOT, COMMA, QUOTE, L, I = 32, 46, 44, 39, 108, 105
+
+    # 1. URL を空白1つに置き換える (https?://[url文字]+)
+    n = len(src)
+    a = np.empty(n, dtype=np.uint8)
+    na = 0
+    i = 0
+    while i < n:
+        if i + 4 <= n and src[i] == 104 and src[i + 1] == 116 and src[i + 2] == 116 and src[i + 3] == 112:
+            k = i + 4
+            if k < n and src[k] == 115:
+                k += 1
+            if k + 3 < n and src[k] == 58 and src[k + 1] == 47 and src[k + 2] == 47 and _is_url_char(src[k + 3]):
+                k += 3
+                while k < n and _is_url_char(src[k]):
+                    k += 1
+                a[na] = SP
+                na += 1
+                i = k
+                continue
+        a[na] = src[i]
+        na += 1
+        i += 1
+
+    # 2. 小文字化、括弧書き・許可文字以外を空白に、"," -> " , "、"!"/"." -> ". "
+    b = np.empty(3 * na, dtype=np.uint8)
+    nb = 0
+    i = 0
+    while i < na:
+        c = a[i]
+        if 65 <= c <= 90:
+            c += 32
+        if c == 40:
+            k = i + 1
+            while k < na and a[k] != 41 and a[k] != 10:
+                k += 1
+            if k < na and a[k] == 41:
+                b[nb] = SP
+                nb += 1
+                i = k + 1
+                continue
+        if c == COMMA:
+            b[nb] = SP
+            b[nb + 1] = COMMA
+            b[nb + 2] = SP
+            nb += 3
+        elif c == 33 or c == DOT:
+            b[nb] = DOT
+            b[nb + 1] = SP
+            nb += 2
+        elif _is_allowed_char(c):
+            b[nb] = c
+            nb += 1
+        else:
+            b[nb] = SP
+            nb += 1
+        i += 1
+
+    # 3. 句点の連続(前後の空白含む)は ". " に、空白の連続は " " にまとめる
+    d = np.empty(nb, dtype=np.uint8)
+    nd = 0
+    i = 0
+    while i < nb:
+        c = b[i]
+        if c == SP or c == DOT:
+            k = i
+            while k < nb and b[k] == SP:
+                k += 1
+            if k + 1 < nb and b[k] == DOT and (b[k + 1] == SP or b[k + 1] == DOT):
+                k += 1
+                while k < nb and (b[k] == SP or b[k] == DOT):
+                    k += 1
+                d[nd] = DOT
+                d[nd + 1] = SP
+                nd += 2
+                i = k
+                continue
+            if c == SP:
+                d[nd] = SP
+                nd += 1
+                i = k
+                continue
+        d[nd] = c
+        nd += 1
+        i += 1
+
+    # 4. "' " -> "'", " l ," -> " i,", " l " -> " i ", " ," -> ","
+    e = np.empty(nd, dtype=np.uint8)
+    ne = 0
+    i = 0
+    while i < nd:
+        c = d[i]
+        if c == QUOTE and i + 1 < nd and d[i + 1] == SP:
+            e[ne] = QUOTE
+            ne += 1
+            i += 2
+            continue
+        if c == SP and i + 2 < nd and d[i + 1] == L and d[i + 2] == SP:
+            if i + 3 < nd and d[i + 3] == COMMA:
+                e[ne] = SP
+                e[ne + 1] = I
+                e[ne + 2] = COMMA
+                ne += 3
+                i += 4
+            else:
+                e[ne] = SP
+                e[ne + 1] = I
+                e[ne + 2] = SP
+                ne += 3
+                i += 3
+            continue
+        if c == SP and i + 1 < nd and d[i + 1] == COMMA:
+            e[ne] = COMMA
+            ne += 1
+            i += 2
+            continue
+        e[ne] = c
+        ne += 1
+        i += 1
+
+    # 前後の空白を除き、先頭の "l " は "i " にする
+    start = 0
+    end = ne
+    while start < end and e[start] == SP:
+        start += 1
+    while end > start and e[end - 1] == SP:
+        end -= 1
+    out = e[start:end].copy()
+    if len(out) >= 2 and out[0] == L and out[1] == SP:
+        out[0] = I
+    return out
+
+
+@functools.lru_cache(maxsize=100_000)
 def preprocess(text):
-    if type(text)!=float:
-        text = re.sub("https?://[\w!\?/\+\-_~=;\.,\*&@#\$%\(\)'\[\]]+", ' ', text)
-        text = text.lower()
-        text = re.sub('\(.*?\)',' ',text)
-        text = re.sub('\s',' ',text)
-        text = re.sub("’","'",text)
-        text = re.sub(r"[^a-zA-z0-9.,?!/&%$']",' ',text)
-        text = re.sub(",",' , ',text)
-        text = re.sub("!",'. ',text)
-        text = re.sub("\.",'. ',text)
-        text = re.sub("\s+",' ',text)
-        text = re.sub(r"[\s]*\.[\.\s]+",". ",text)
-        text = re.sub("' ","'",text)
-        text = re.sub(" l "," i ",text)
-        text = re.sub(" ,",",",text)
-        if text[-1]==" ":
-            text=text[:-1]
-        if text[0]==" ":
-            text=text[1:]
-        if text[:2]=="l ":
-            text="i "+text[2:]
-        return text
+    if isinstance(text, str):
+        if text.isascii():
+            src = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+            return _preprocess_ascii(src).tobytes().decode("ascii")
+        # 非ASCII(’ など)を含む場合は正規表現版で処理する
+        return _preprocess_regex(text)
     else:
-        return np.nan
\ No newline at end of file
+        return np.nan
+
+
+def preprocess_series(s: pd.Series) -> pd.Series:
+    # preprocess を1行ずつ map する代わりに、Series.str のベクトル化された置換で一括処理する
+    # object 型にそろえて欠損値を NaN にしておけば、.str は NaN をそのまま通すので行の除外・復元は不要
+    # (index で戻すと重複ラベルのある Series で値がずれたりエラーになったりする)
+    return (
+        s.astype(object).where(s.notna())
+        .str.replace(_URL_RE, ' ', regex=True)
+        .str.lower()
+        .str.translate(_CHAR_TABLE)
+        .str.replace(_STRIP_RE, ' ', regex=True)
+        .str.replace(_SPACE_RE, _space_repl, regex=True)
+        .str.replace(_FIXUP_RE, _fixup_repl, regex=True)
+        .str.strip()
+        .str.replace(r"^l ", "i ", regex=True)
+    )
+
+
+# _preprocess_ascii と _preprocess_regex の出力が一致することを境界ケースで確認する
+# (どちらかを変更したときに両者がずれないよう、変更後はこのチェックを実行すること)
+_EQUIVALENCE_CASES = [
+    "",
+    "   ",
+    "http://",
+    "see http:// here",
+    "https://",
+    "http:/x",
+    "go to https://example.com/a?b=1&c=(2) now",
+    "HTTP://Example.com",
+    "unclosed ( paren",
+    "a (closed) b",
+    "a (across\nlines) b",
+    "a (x) (y) c",
+    "( only",
+    ") only",
+    "l think so",
+    "yes l , no",
+    " l ,",
+    "a l l b",
+    "it ' s",
+    "' ",
+    "[\\]^_`",
+    "A-z range [x] ^y_ `z`",
+    "end...",
+    "a . . . b",
+    "wow!!! really?",
+    "a ,b , c",
+    "tab\tnew\nline\rcarriage\x0bvt\x0cff",
+    "1,000.50 $ 20% & a/b",
+    "l ",
+    "L",
+]
+
+
+def check_preprocess_ascii():
+    for text in _EQUIVALENCE_CASES:
+        src = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+        fast = _preprocess_ascii(src).tobytes().decode("ascii")
+        slow = _preprocess_regex(text)
+        assert fast == slow, (text, fast, slow)
+
+
+if __name__ == "__main__":
+    check_preprocess_ascii()
+    print("preprocess: ascii/regex paths match on", len(_EQUIVALENCE_CASES), "cases")
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+
+import pytest
+from langchain_core.messages import AIMessage
+from pydantic import ValidationError
+
+# agent.py はモジュール読み込み時に ChatOpenAI を生成するため、ダミーのキーを入れておく
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import agent
+
+
+def test_query_joins_query_parts():
+    state = agent.QueryState(query_parts=["質問", "[Agent1 says]: No date appended."])
+    assert state.query == "質問\n[Agent1 says]: No date appended."
+
+
+def test_query_parts_default_is_not_shared():
+    first = agent.QueryState()
+    first.query_parts.append("x")
+    first.debug_info.append("x")
+    second = agent.QueryState()
+    assert second.query_parts == []
+    assert second.debug_info == []
+
+
+def test_query_argument_is_rejected():
+    with pytest.raises(ValidationError):
+        agent.QueryState(query="質問")
+
+
+class FakeLLM:
+    def __init__(self, http_async_client, delay=0.0):
+        self.delay = delay
+
+    async def abatch(self, prompts, return_exceptions=False):
+        await asyncio.sleep(self.delay)
+        return [ValueError(p) if p == "bad" else p.upper() for p in prompts]
+
+
+def test_dispatcher_does_not_wait_for_in_flight_batch():
+    dispatcher = agent.BatchingDispatcher(lambda client: FakeLLM(client, delay=0.5))
+
+    async def submit_after(delay, prompt):
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        result = await dispatcher.submit(prompt)
+        return result, time.perf_counter() - start
+
+    async def main():
+        return await asyncio.gather(submit_after(0, "a"), submit_after(0.1, "b"))
+
+    (first, first_elapsed), (second, second_elapsed) = asyncio.run(main())
+    assert (first, second) == ("A", "B")
+    # 2件目は1件目の往復を待たずに送られる
+    assert second_elapsed < 0.9
+
+
+def test_dispatcher_isolates_failed_prompt():
+    dispatcher = agent.BatchingDispatcher(FakeLLM)
+
+    async def main():
+        return await asyncio.gather(
+            dispatcher.submit("ok"), dispatcher.submit("bad"), return_exceptions=True
+        )
+
+    ok, bad = asyncio.run(main())
+    assert ok == "OK"
+    assert isinstance(bad, ValueError)
+
+
+def test_dispatcher_fails_pending_callers_when_worker_fails():
+    def broken_factory(client):
+        raise RuntimeError("factory failed")
+
+    dispatcher = agent.BatchingDispatcher(broken_factory)
+
+    async def main():
+        return await asyncio.wait_for(
+            asyncio.gather(dispatcher.submit("a"), dispatcher.submit("b"), return_exceptions=True),
+            timeout=2,
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert dispatcher._worker is None
+
+
+class FakeAgent:
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+
+    def _result(self):
+        self.calls += 1
+        return {"messages": [AIMessage(content=self.answer)]}
+
+    def invoke(self, inputs):
+        return self._result()
+
+    async def ainvoke(self, inputs):
+        return self._result()
+
+
+def run_graph(monkeypatch, question, agent4_answer, prompt_answers):
+    agents = {
+        agent.AGENT3_SPEC["name"]: FakeAgent("[Agent3] info"),
+        agent.AGENT4_SPEC["name"]: FakeAgent(agent4_answer),
+    }
+    monkeypatch.setattr(agent, "build_agent", lambda name, **kwargs: agents[name])
+
+    answers = iter(prompt_answers)
+
+    async def fake_submit(prompt):
+        return AIMessage(content=next(answers))
+
+    monkeypatch.setattr(agent.prompt_dispatcher, "submit", fake_submit)
+
+    graph = agent.build_graph(cache=None)
+    visited = []
+
+    async def main():
+        async for chunk in graph.astream(
+            agent.QueryState(query_parts=[question]), stream_mode="updates"
+        ):
+            visited.extend(chunk)
+
+    asyncio.run(main())
+    return visited, agents
+
+
+def test_graph_takes_only_the_chosen_branches(monkeypatch):
+    # 特殊用語あり -> Router1 は prompt1 へ (agent3 は通らない)、Agent4 が Yes -> END
+    visited, agents = run_graph(monkeypatch, "特殊用語とは?", "Yes", ["回答案"])
+    assert "agent3" not in visited
+    assert "prompt2" not in visited
+    assert visited.count("prompt1") == 1
+    assert agents[agent.AGENT4_SPEC["name"]].calls == 1
+
+
+def test_graph_stops_at_max_retries(monkeypatch):
+    # Agent4 が常に No でも、回答が変わり続ける限り MAX_RETRIES 回で終了する
+    answers = ["回答案"] + [f"改善{i}" for i in range(10)]
+    visited, _ = run_graph(monkeypatch, "質問です", "No", answers)
+    assert visited.count("prompt2") == agent.MAX_RETRIES
+    assert visited[-1] == "prompt2"
+
+
+def test_graph_stops_when_answer_converges(monkeypatch):
+    # Prompt2 の回答が Prompt1 の回答案と同じなら、上限前でも終了する
+    visited, _ = run_graph(monkeypatch, "質問です", "No", ["同じ回答", "同じ回答"])
+    assert visited.count("prompt2") == 1
+    assert visited.count("agent4") == 1
+
+
+def test_prompt2_next_node_continues_when_answer_changed():
+    draft = agent.answer_hash("回答案")
+    assert agent.prompt2_next_node(1, agent.answer_hash("改善した回答"), draft) == ("agent2", None)
+
+
+def test_prompt2_next_node_ends_when_answer_unchanged():
+    # 1回目でも Prompt1 の回答案と同じなら収束として終了
+    draft = agent.answer_hash("回答案")
+    goto, reason = agent.prompt2_next_node(1, draft, draft)
+    assert goto == agent.END
+    assert "unchanged" in reason
+
+
+def test_prompt2_next_node_ends_at_max_retries():
+    draft = agent.answer_hash("回答案")
+    goto, reason = agent.prompt2_next_node(agent.MAX_RETRIES, agent.answer_hash("別の回答"), draft)
+    assert goto == agent.END
+    assert "MAX_RETRIES" in reason